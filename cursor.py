@@ -1,5 +1,7 @@
 """Implements cursor logic, including key repeats and dissolve timing."""
 
+import math
+
 REPEAT_TRIGGER = 0.75
 REPEAT_INTERVAL = 0.05
 DISSOLVE_TIME = 0.35
@@ -47,10 +49,12 @@ class _Repeater:
             return self._countdown()
 
     def _countdown(self):
-        fires = 0
-        while self.stopwatch > REPEAT_INTERVAL:
-            fires += 1
-            self.stopwatch -= REPEAT_INTERVAL
+        # Closed form of "while stopwatch > REPEAT_INTERVAL: subtract and
+        # fire", so a long dt (e.g. after the app was suspended) costs O(1).
+        if self.stopwatch <= REPEAT_INTERVAL:
+            return 0
+        fires = math.ceil(self.stopwatch / REPEAT_INTERVAL) - 1
+        self.stopwatch -= fires * REPEAT_INTERVAL
         return fires
 
 
@@ -69,10 +73,13 @@ class Cursor:
         old_value = self.cursor
         # Avoid oscillations when holding both keys.
         if not (reverse and forward):
-            self.cursor -= self.rev.tick(dt, reverse)
-            self.cursor += self.fwd.tick(dt, forward)
-            self.cursor = min(self.cursor, self.nslides - 1)
-            self.cursor = max(self.cursor, 0)
+            rev_fires = self.rev.tick(dt, reverse)
+            fwd_fires = self.fwd.tick(dt, forward)
+            # Most ticks fire nothing - skip the clamp and store for those.
+            if rev_fires or fwd_fires:
+                new = self.cursor + fwd_fires - rev_fires
+                last = self.nslides - 1
+                self.cursor = 0 if new < 0 else (last if new > last else new)
         if self.cursor != old_value:
             self.prev_cursor = old_value
             # Don't use dissolves when rapid-changing.
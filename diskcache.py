@@ -0,0 +1,189 @@
+"""Persistent on-disk cache of rasterized pages."""
+
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+
+# Favor speed over ratio: the point is to beat re-rendering on startup.
+COMPRESSION_LEVEL = 1
+# Upper bound on the total size of the cache directory, in bytes. When a
+# store() takes us over, we delete the least recently used page directories
+# down to PRUNE_TO of it, so the next few stores do not walk the tree again.
+MAX_BYTES = 2 * 2**30
+PRUNE_TO = 0.75
+
+_HEADER = struct.Struct("<II")
+
+
+def _default_root():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "pypdfdeck")
+
+
+class DiskCache:
+    """Stores rendered pages under <root>/<path hash>/<revision>/<w>x<h>/.
+
+    The path hash covers the absolute path of the PDF, and the revision is its
+    size and modification time, so editing and recompiling a deck naturally
+    misses the old entries. Each entry is a small (width, height) header
+    followed by the zlib-compressed raw RGB pixels. Any kind of read or write
+    failure is treated as a cache miss - the cache is never required for
+    correctness.
+
+    Old revisions of the deck are deleted, and the whole cache is kept under
+    MAX_BYTES by deleting the least recently used <w>x<h> directories. Both
+    happen in store(), never in the constructor, so creating a DiskCache is
+    cheap enough for the GUI thread.
+    """
+    def __init__(self, pdfpath, root=None):
+        if root is None:
+            root = _default_root()
+        stat = os.stat(pdfpath)
+        path = os.path.abspath(pdfpath).encode("utf-8")
+        self.root = root
+        self.deck_dir = os.path.join(root, hashlib.sha1(path).hexdigest())
+        self.revision = f"{stat.st_size}-{stat.st_mtime_ns}"
+        self.dir = os.path.join(self.deck_dir, self.revision)
+        # Directories we know exist, so store() creates each one only once
+        # instead of paying for makedirs on every page.
+        self.made_dirs = set()
+        # Directories we have marked as recently used in this session.
+        self.used_dirs = set()
+        # Bytes in the cache (as far as we know), or None before the first
+        # store() has looked.
+        self.bytes = None
+
+    def load(self, image_size, index):
+        """Returns the cached RGB array for the page, or None on a miss."""
+        try:
+            with open(self._path(image_size, index), "rb") as f:
+                data = f.read()
+            width, height = _HEADER.unpack_from(data)
+            raw = zlib.decompress(data[_HEADER.size:])
+            pixels = np.frombuffer(raw, dtype=np.uint8)
+            pixels = pixels.reshape((height, width, 3))
+        except (OSError, ValueError, struct.error, zlib.error):
+            return None
+        self._mark_used(os.path.dirname(self._path(image_size, index)))
+        return pixels
+
+    def store(self, image_size, index, pixels):
+        """Writes the RGB array for the page, replacing any existing entry."""
+        path = self._path(image_size, index)
+        height, width, _ = pixels.shape
+        header = _HEADER.pack(width, height)
+        data = zlib.compress(pixels.tobytes(), COMPRESSION_LEVEL)
+        dirname = os.path.dirname(path)
+        if self.bytes is None:
+            self._remove_old_revisions()
+            self.bytes = sum(nbytes for _, _, nbytes in self._page_dirs())
+        if self.bytes > MAX_BYTES:
+            self.bytes = self._prune(PRUNE_TO * MAX_BYTES)
+        try:
+            fd, tmppath = self._mkstemp(dirname)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                f.write(data)
+            os.replace(tmppath, path)
+            self.bytes += _HEADER.size + len(data)
+        except OSError:
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
+
+    # Private methods.
+    def _mkstemp(self, dirname):
+        if dirname not in self.made_dirs:
+            os.makedirs(dirname, exist_ok=True)
+            self.made_dirs.add(dirname)
+        # Write then rename, so a crash never leaves a truncated entry.
+        try:
+            return tempfile.mkstemp(dir=dirname)
+        except FileNotFoundError:
+            # Someone deleted the directory since we made it: another window's
+            # DiskCache pruning the same root, or another process. Make it
+            # again, once.
+            self.made_dirs.discard(dirname)
+            os.makedirs(dirname, exist_ok=True)
+            self.made_dirs.add(dirname)
+            return tempfile.mkstemp(dir=dirname)
+
+    def _mark_used(self, dirname):
+        # Page directories are pruned oldest-mtime-first, so bump the mtime of
+        # those we read from, not just those we write to.
+        if dirname in self.used_dirs:
+            return
+        self.used_dirs.add(dirname)
+        try:
+            os.utime(dirname)
+        except OSError:
+            pass
+
+    def _remove_old_revisions(self):
+        try:
+            names = os.listdir(self.deck_dir)
+        except OSError:
+            return
+        for name in names:
+            if name != self.revision:
+                path = os.path.join(self.deck_dir, name)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _page_dirs(self):
+        """Returns (mtime, path, bytes) of every directory holding entries."""
+        dirs = []
+        for dirpath, _, filenames in os.walk(self.root):
+            nbytes = 0
+            for name in filenames:
+                try:
+                    nbytes += os.stat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+            if not nbytes:
+                continue
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                continue
+            dirs.append((mtime, dirpath, nbytes))
+        return dirs
+
+    def _prune(self, budget):
+        """Deletes page directories, least recently used first, down to budget.
+
+        Returns the number of bytes left in the cache.
+        """
+        dirs = sorted(self._page_dirs())
+        total = sum(nbytes for _, _, nbytes in dirs)
+        for _, dirpath, nbytes in dirs:
+            if total <= budget:
+                break
+            shutil.rmtree(dirpath, ignore_errors=True)
+            self.made_dirs.discard(dirpath)
+            self.used_dirs.discard(dirpath)
+            total -= nbytes
+            # Also remove the deck and revision directories once they are
+            # empty. rmdir refuses to remove a non-empty directory.
+            parent = os.path.dirname(dirpath)
+            while parent != self.root:
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        return total
+
+    def _path(self, image_size, index):
+        width, height = image_size
+        subdir = f"{round(width)}x{round(height)}"
+        return os.path.join(self.dir, subdir, f"{index}.z")
@@ -1,23 +1,18 @@
 import argparse
+import ctypes
+import math
 import time
 
-import pdf2image
 import pyglet
+import pypdfium2 as pdfium
 
 from cursor import Cursor
-from rasterizer import ThreadedRasterizer
+from rasterizer import SharedRasterizer
 
 
-KEYS_FWD = [
-    pyglet.window.key.RIGHT,
-    pyglet.window.key.UP,
-    pyglet.window.key.PAGEDOWN,
-]
-KEYS_REV = [
-    pyglet.window.key.LEFT,
-    pyglet.window.key.DOWN,
-    pyglet.window.key.PAGEUP,
-]
+# Nothing at module scope may touch pyglet.window, pyglet.gl, or pyglet.font.
+# Importing any of them opens a display connection and creates a hidden GL
+# window, and the render processes import this module as __mp_main__.
 
 SLOW_TICK = 0.5
 FAST_TICK = 1.0 / 60
@@ -25,13 +20,97 @@ FAST_TICK = 1.0 / 60
 COLOR_OK = (50, 100, 200, 255)
 COLOR_OVERTIME = (200, 50, 50, 255)
 
+# Texture arrays are created this many layers at a time, so a render only
+# takes as much GPU memory as the pages that have actually arrived.
+TEXTURE_CHUNK = 16
+
+
+def array2pyglet(pixels):
+    """Converts an RGB array from the rasterizer into a Pyglet image."""
+    # Copy the rows out bottom-up, which is what OpenGL wants. With a negative
+    # pitch instead, Pyglet would reverse the rows itself in pure Python on
+    # every texture upload.
+    height, width, _ = pixels.shape
+    raw = pixels[::-1].tobytes()
+    return pyglet.image.ImageData(width, height, "RGB", raw, pitch=width * 3)
+
+
+def create_rgb_texture_array(width, height, depth):
+    """Creates an empty TextureArray storing 3 bytes per pixel, not 4."""
+    # TextureArray.create passes its internalformat as the pixel format too,
+    # which is invalid for a sized format like GL_RGB8, so allocate it here.
+    gl = pyglet.gl
+    cls = pyglet.image.TextureArray
+    tex_id = gl.GLuint()
+    target = gl.GL_TEXTURE_2D_ARRAY
+    gl.glGenTextures(1, ctypes.byref(tex_id))
+    gl.glBindTexture(target, tex_id.value)
+    gl.glTexParameteri(
+        target, gl.GL_TEXTURE_MIN_FILTER, cls.default_min_filter)
+    gl.glTexParameteri(
+        target, gl.GL_TEXTURE_MAG_FILTER, cls.default_mag_filter)
+    gl.glTexImage3D(
+        target, 0, gl.GL_RGB8, width, height, depth, 0,
+        gl.GL_RGB, gl.GL_UNSIGNED_BYTE, None)
+    texture = cls(width, height, target, tex_id.value, depth)
+    texture.min_filter = cls.default_min_filter
+    texture.mag_filter = cls.default_mag_filter
+    return texture
+
+
+class PageTextures:
+    """A fixed number of equally-sized RGB layers in GPU texture arrays.
+
+    Each texture array holds TEXTURE_CHUNK layers (capped by the GPU's layer
+    limit) and is only created when one of its layers is first written.
+    """
+    def __init__(self, width, height, count):
+        self.width = width
+        self.height = height
+        self.count = count
+        max_layers = pyglet.image.get_max_array_texture_layers()
+        self.chunk = min(TEXTURE_CHUNK, max_layers)
+        self.textures = [None] * math.ceil(count / self.chunk)
+
+    def set(self, layer, image):
+        """Uploads the ImageData into the layer and returns its region."""
+        i, z = divmod(layer, self.chunk)
+        texture = self.textures[i]
+        if texture is None:
+            depth = min(self.chunk, self.count - i * self.chunk)
+            texture = create_rgb_texture_array(self.width, self.height, depth)
+            self.textures[i] = texture
+        texture.blit_into(image, 0, 0, z)
+        return texture.region_class(
+            0, 0, z, image.width, image.height, texture)
+
+
+def navigation_keys():
+    """Returns frozensets of the keys that move forward and in reverse."""
+    key = pyglet.window.key
+    forward = frozenset((key.RIGHT, key.UP, key.PAGEDOWN))
+    reverse = frozenset((key.LEFT, key.DOWN, key.PAGEUP))
+    return forward, reverse
+
+
+class PressedKeys:
+    """Window event handler tracking the set of keys currently held down.
+
+    Lets the tick handler test a whole group of keys with one set operation
+    instead of one lookup per key. (Like pyglet's KeyStateHandler, which we
+    cannot subclass at module scope - see above.)
+    """
+    def __init__(self):
+        self.pressed = set()
+
+    def on_key_press(self, symbol, modifiers):
+        self.pressed.add(symbol)
 
-def PIL2pyglet(image):
-    """Converts a PIL image from the rasterizer into a Pyglet image."""
-    raw = image.tobytes()
-    image = pyglet.image.ImageData(
-        image.width, image.height, "RGB", raw, pitch=-image.width * 3)
-    return pyglet.sprite.Sprite(image)
+    def on_key_release(self, symbol, modifiers):
+        self.pressed.discard(symbol)
+
+    def on_deactivate(self):
+        self.pressed.clear()
 
 
 def compute_image_height(doc_aspect, win_w, win_h, extras_ratio):
@@ -62,8 +141,9 @@ def compute_image_height(doc_aspect, win_w, win_h, extras_ratio):
 
 class TimerDisplay:
     """Timing code and text output for countdown timer."""
-    def __init__(self, duration_secs):
+    def __init__(self, duration_secs, pix2font):
         self.duration = duration_secs
+        self.pix2font = pix2font
         self.started = None
 
     def label(self, **kwargs):
@@ -105,7 +185,6 @@ def pix2font():
     return min(ratios)
 
 
-PIX2FONT = pix2font()
 TIMER_MARGIN_TOP_RATIO = 0.0
 TIMER_RATIO = 0.17
 TIMER_MARGIN_BOTTOM_RATIO = 0.04
@@ -117,18 +196,30 @@ FONTS = ("Monaco", "Inconsolata",)
 
 
 class Window:
-    def __init__(self, name, pdfpath, cursor, offset, timer=None):
+    def __init__(self, name, rasterizer, cursor, offset, timer=None):
         self.name = name
         self.cursor = cursor
         self.offset = offset
-        self.rasterizer = ThreadedRasterizer(pdfpath, pagelimit=cursor.nslides)
-        self.sprites = [None] * (cursor.nslides + 2)
+        self.rasterizer = rasterizer
+        # The GPU mirrors the slots of the render we are showing: one texture
+        # layer and sprite per slot, plus one for the black out-of-bounds
+        # slide. We upload each page once, as it lands in its slot.
+        self.textures = None
+        self.black = None
+        self.slot_sprites = None
+        self.slot_pages = None
+        self.page_slots = None
+        self.uploaded = None
+        self.uploaded_ready = None
+        self.nuploaded = 0
         self.window = pyglet.window.Window(caption=name, resizable=True)
         self.window.set_handler("on_resize", self.on_resize)
         self.window.set_handler("on_draw", self.on_draw)
         self.window.set_handler("on_close", self.on_close)
         self.ticks = 0
         self.timer = timer
+        # So the rasterizer knows our slides before our first resize.
+        self.push_cursor()
 
     # Event handlers.
     def on_resize(self, width, height):
@@ -139,7 +230,7 @@ class Window:
             self._timer_height_factor()
         )
         img_w = self.rasterizer.aspect * img_h
-        self.rasterizer.push_resize(img_w, img_h)
+        self.rasterizer.push_resize(self.name, img_w, img_h)
 
     def on_draw(self):
         self.ticks += 1
@@ -159,7 +250,7 @@ class Window:
         if self.timer is not None:
             img_h = sprites[0].height
             heights = [r * img_h for r in HEIGHT_RATIOS]
-            fontsize = PIX2FONT * heights[2]
+            fontsize = self.timer.pix2font * heights[2]
             content_height = sum(heights)
             pad = (self.window.height - content_height) / 2
             label = self.timer.label(
@@ -182,21 +273,76 @@ class Window:
         return pyglet.event.EVENT_HANDLED
 
     def on_close(self):
-        self.rasterizer.shutdown()
+        self.rasterizer.remove(self.name)
+
+    def push_cursor(self):
+        """Lets the rasterizer prioritize the pages near the slides we show."""
+        pages = (
+            self.cursor.prev_cursor + self.offset,
+            self.cursor.cursor + self.offset,
+        )
+        self.rasterizer.push_cursor(self.name, pages)
 
     # Private methods.
     def _timer_height_factor(self):
         return EXTRAS_RATIO if self.timer is not None else 0.0
 
     def _get_sprite(self, index):
-        image = self.rasterizer.get(index)
-        if image is None:
+        render, ready = self.rasterizer.get_all(self.name)
+        if render is None:
             return None
-        sprite = self.sprites[index + 1]
-        if sprite is None or (sprite.width, sprite.height) != image.size:
-            sprite = PIL2pyglet(image)
-            self.sprites[index + 1] = sprite
-        return sprite
+        # A new ready list means the rasterizer started counting from scratch,
+        # even if the render is the same.
+        if render is not self.uploaded or ready is not self.uploaded_ready:
+            self._start_upload(render, ready)
+        # Upload pages as they arrive, so changing slides never stalls on
+        # creating and filling a texture.
+        for slot, page in ready[self.nuploaded:]:
+            self._upload(slot, page)
+        self.nuploaded = len(ready)
+        if not 0 <= index < render.npages:
+            return self.black
+        slot = self.page_slots.get(index)
+        return None if slot is None else self.slot_sprites[slot]
+
+    def _start_upload(self, render, ready):
+        nslots, height, width, _ = render.slab.shape
+        # Layer 0 is black, and slot i goes in layer i + 1.
+        self.textures = PageTextures(width, height, nslots + 1)
+        # Take black from the render itself rather than from the rasterizer,
+        # which may have moved on to another size.
+        region = self.textures.set(0, array2pyglet(render.black))
+        self.black = pyglet.sprite.Sprite(region)
+        self.slot_sprites = [None] * nslots
+        self.slot_pages = [None] * nslots
+        self.page_slots = {}
+        self.uploaded = render
+        self.uploaded_ready = ready
+        self.nuploaded = 0
+
+    def _upload(self, slot, page):
+        render = self.uploaded
+        # The worker may reuse the slot at any time, but it clears
+        # render.pages[slot] first. If the page is still there after we copied
+        # the pixels, the copy is good. If not, a later entry in ready will
+        # bring the slot's new page.
+        if render.pages[slot] != page:
+            return
+        image = array2pyglet(render.slab[slot])
+        if render.pages[slot] != page:
+            return
+        old = self.slot_pages[slot]
+        if old == page and self.page_slots.get(page) == slot:
+            # Already uploaded, e.g. when a render we switch to already has
+            # resident pages that are also still on their way to us.
+            return
+        if old is not None and self.page_slots.get(old) == slot:
+            del self.page_slots[old]
+        self.slot_pages[slot] = page
+        self.page_slots[page] = slot
+        region = self.textures.set(slot + 1, image)
+        if self.slot_sprites[slot] is None:
+            self.slot_sprites[slot] = pyglet.sprite.Sprite(region)
 
     def _draw_loading(self):
         k = self.ticks % 4
@@ -230,35 +376,52 @@ def main():
     )
     args = parser.parse_args()
 
-    info = pdf2image.pdfinfo_from_path(args.path)
+    # Read everything we need from the PDF here, once, instead of separately
+    # in every rasterizer.
+    pdf = pdfium.PdfDocument(args.path)
+    npages = len(pdf)
+    page_w, page_h = pdf[0].get_size()
     print("PDF info:")
-    for k, v in info.items():
+    for k, v in pdf.get_metadata_dict(skip_empty=True).items():
         print(f"{k}: {v}")
-    npages = info["Pages"]
+    print(f"Pages: {npages}")
+    print(f"Page size: {page_w:g} x {page_h:g} pts")
+    pdf.close()
+    aspect = page_w / page_h
     if args.pages is not None:
         npages = min(npages, args.pages)
 
+    # One rasterizer for both windows, so they can share work when their image
+    # sizes match. Create it first, so its render processes start before we
+    # have any windows or GL state.
+    rasterizer = SharedRasterizer(args.path, aspect, pagelimit=npages)
+
     cursor = Cursor(npages)
     if args.countdown is not None:
-        timer = TimerDisplay(args.countdown * 60)
+        timer = TimerDisplay(args.countdown * 60, pix2font())
     else:
         timer = None
-    presenter = Window("presenter", args.path, cursor, offset=1, timer=timer)
-    audience = Window("audience", args.path, cursor, offset=0)
+    keys_fwd, keys_rev = navigation_keys()
+    presenter = Window("presenter", rasterizer, cursor, offset=1, timer=timer)
+    audience = Window("audience", rasterizer, cursor, offset=0)
 
     def on_tick(dt, keyboard):
         nonlocal cursor
-        forward = any(keyboard[k] for k in KEYS_FWD)
-        reverse = any(keyboard[k] for k in KEYS_REV)
+        forward = not keyboard.pressed.isdisjoint(keys_fwd)
+        reverse = not keyboard.pressed.isdisjoint(keys_rev)
+        old_cursor = cursor.cursor
         if not cursor.tick(dt, reverse, forward):
             pyglet.clock.unschedule(on_tick)
             # Slow tick so we draw after rasterizer is done.
             pyglet.clock.schedule_interval(on_tick, SLOW_TICK, keyboard=keyboard)
+        if cursor.cursor != old_cursor:
+            presenter.push_cursor()
+            audience.push_cursor()
 
     # Tick slowly except when we are updating the screen - which always begins
     # with a key press. on_tick will slow itself back down later.
     def on_key_press(window, symbol, modifiers):
-        if symbol in KEYS_FWD or symbol in KEYS_REV:
+        if symbol in keys_fwd or symbol in keys_rev:
             pyglet.clock.unschedule(on_tick)
             pyglet.clock.schedule_interval(on_tick, FAST_TICK, keyboard=keyboard)
 
@@ -268,7 +431,7 @@ def main():
     audience.window.set_handler(
         "on_key_press", lambda sym, mod: on_key_press(audience, sym, mod))
 
-    keyboard = pyglet.window.key.KeyStateHandler()
+    keyboard = PressedKeys()
     presenter.window.push_handlers(keyboard)
     audience.window.push_handlers(keyboard)
     pyglet.clock.schedule_interval(on_tick, SLOW_TICK, keyboard=keyboard)
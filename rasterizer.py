@@ -1,18 +1,39 @@
 """Threaded interruptible PDF rasterizer."""
 
+import concurrent.futures
+import concurrent.futures.process
 from dataclasses import dataclass
+import math
+import multiprocessing
+from multiprocessing import shared_memory
 import os
 import queue
 import threading
 import time
 from typing import Any, Dict
-
-import pdf2image
-
-
-CHUNK_PAGES = 32
-MAX_THREADS = os.cpu_count() - 1
-LRU_SIZE = 4
+import weakref
+
+import numpy as np
+import pypdfium2 as pdfium
+
+from diskcache import DiskCache
+
+
+# Memory budget for each rasterizer's pixels, in bytes. This covers the render
+# we are showing as well as those kept for sizes we might switch back to.
+CACHE_BYTES = 512 * 2**20
+# A render holds at most this many bytes of pages around the cursor...
+RENDER_BYTES = CACHE_BYTES // 2
+# ...but at least this many pages, so the slides a window blends between and
+# their neighbors stay resident even at absurd sizes.
+MIN_SLOTS = 4
+# Renders whose pages took less than this to produce in total are not worth
+# keeping when we switch sizes. (They are usually disk cache hits, and the
+# disk cache will serve them again.)
+MIN_CACHE_SECS = 0.5
+# PDFium is not thread-safe, so we render in processes instead. Leave one core
+# for the GUI.
+MAX_PROCESSES = max(1, os.cpu_count() - 1)
 
 _EXIT_SENTINEL = -1
 _IDLE_SENTINEL = -2
@@ -26,15 +47,21 @@ _IDLE_SENTINEL = -2
 # needed to ensure that age counters are no larger than the cache size. Also,
 # we could use a priority queue for O(log N) evicition, but our cache size is
 # not big enough for that to matter.
+#
+# Items are evicted by total cost (e.g. bytes) rather than count, because one
+# render of a long deck at 4K can be bigger than many small ones.
 class LRUDict:
     @dataclass
     class _LRUEntry:
         used: int
+        cost: int
         item: Any
 
-    def __init__(self, size):
+    def __init__(self, budget, cost=lambda item: 1):
         self.dict: Dict[Any, LRUDict._LRUEntry] = {}
-        self.size: int = size
+        self.budget: int = budget
+        self.cost = cost
+        self.total: int = 0
         self.counter: int = 0
 
     def __contains__(self, key):
@@ -47,11 +74,77 @@ class LRUDict:
         return entry.item
 
     def __setitem__(self, key, value):
-        if (len(self.dict) == self.size) and (key not in self.dict):
-            key_oldest, _ = min(self.dict.items(), key=lambda item: item[1].used)
-            del self.dict[key_oldest]
-        self.dict[key] = LRUDict._LRUEntry(self.counter, value)
+        if key in self.dict:
+            self.total -= self.dict.pop(key).cost
+        cost = self.cost(value)
+        self.dict[key] = LRUDict._LRUEntry(self.counter, cost, value)
+        self.total += cost
         self.counter += 1
+        # The budget is hard: an item bigger than all of it is not kept at all.
+        self._evict()
+
+    def values(self):
+        return [entry.item for entry in self.dict.values()]
+
+    def pop(self, key, default=None):
+        entry = self.dict.pop(key, None)
+        if entry is None:
+            return default
+        self.total -= entry.cost
+        return entry.item
+
+    def clear(self):
+        self.dict.clear()
+        self.total = 0
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        # The budget can be negative, e.g. when what the caller made room for
+        # is bigger than the whole cache. Then everything goes, and no more.
+        while self.dict and self.total > self.budget:
+            key_oldest, _ = min(self.dict.items(), key=lambda item: item[1].used)
+            self.total -= self.dict.pop(key_oldest).cost
+
+
+class Latest:
+    """Single-slot mailbox holding only the most recently set value.
+
+    Replaces the "drain the queue to find the freshest item" pattern: stale
+    values are overwritten on set() instead of piling up, and take() is O(1)
+    and only blocks if asked to. None means "nothing new", so it cannot be
+    used as a value.
+
+    If given, the wakeup Event is also set on every set(), so one thread can
+    wait for news from several mailboxes.
+    """
+    def __init__(self, wakeup=None):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._wakeup = wakeup
+        self._value = None
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+            self._event.set()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def take(self, block=False):
+        """Returns the value set since the last take() and clears it.
+
+        Returns None if there is no new value and block is False.
+        """
+        if block:
+            self._event.wait()
+        with self._lock:
+            value = self._value
+            self._value = None
+            self._event.clear()
+        return value
 
 
 def _winsize2rasterargs(window_size, aspect):
@@ -64,135 +157,738 @@ def _winsize2rasterargs(window_size, aspect):
     return (width, height)
 
 
-def _parse_aspect_from_pdfinfo(info):
-    size_str = info["Page size"]
-    width, _, height, _, _ = size_str.split(" ")
-    return float(width) / float(height)
+# SharedMemory blocks of garbage-collected slabs, waiting to be closed.
+_dead_blocks = []
+
+
+def _slab_shape(image_size, pagelimit):
+    """Returns the (slots, height, width, 3) shape of a render's slab."""
+    width, height = image_size
+    # PDFium rounds bitmap dimensions up.
+    page_shape = (math.ceil(height), math.ceil(width), 3)
+    nslots = max(MIN_SLOTS, RENDER_BYTES // math.prod(page_shape))
+    return (min(pagelimit, nslots), *page_shape)
+
+
+def _new_slab(shape, shared=True):
+    """Allocates black storage for the pages of a render, slots-first.
+
+    The pages of one render share a single contiguous (slots, height, width, 3)
+    RGB array instead of one separately-allocated image per page. If shared,
+    the array lives in shared memory, so render processes write pixels straight
+    into it instead of pickling them back to us. If shared memory is short, or
+    not shared, it lives in plain memory and we must render it ourselves.
+
+    Returns:
+        slab: The array.
+        name: Name of its SharedMemory block, for the render processes, or
+            None if it is in plain memory.
+    """
+    _close_dead_blocks()
+    nbytes = math.prod(shape)
+    if shared:
+        # New shared memory is zero-filled, i.e. black.
+        block = shared_memory.SharedMemory(create=True, size=nbytes)
+        try:
+            _reserve_block(block, nbytes)
+        except OSError as e:
+            print(f"no room for {nbytes / 2**20:.0f} MiB of shared memory "
+                  f"({e.strerror}), rendering in this process.")
+            block.close()
+            block.unlink()
+        else:
+            slab = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+            weakref.finalize(slab, _release_block, block)
+            return slab, block.name
+    return np.zeros(shape, dtype=np.uint8), None
+
+
+def _reserve_block(block, nbytes):
+    """Makes the OS back every byte of the block now, or raises OSError.
+
+    On Linux, shared memory is a file in /dev/shm that only takes up space as
+    it is written. If /dev/shm fills up (Docker gives containers 64 MB by
+    default), writing to the block kills the writer with SIGBUS instead of
+    failing cleanly - which takes down a render process, or us.
+    """
+    path = os.path.join("/dev/shm", block.name)
+    if not hasattr(os, "posix_fallocate") or not os.path.exists(path):
+        return
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.posix_fallocate(fd, 0, nbytes)
+    finally:
+        os.close(fd)
+
+
+def _release_block(block):
+    # Runs while the dying slab still holds the buffer, so the block cannot be
+    # closed yet - just make sure no new process can attach.
+    block.unlink()
+    _dead_blocks.append(block)
+
+
+def _close_dead_blocks():
+    # Callers share this list across threads, so pop defensively.
+    busy = []
+    while True:
+        try:
+            block = _dead_blocks.pop()
+        except IndexError:
+            break
+        try:
+            block.close()
+        except BufferError:
+            busy.append(block)
+    _dead_blocks.extend(busy)
+
 
+def _render_page(pdf, index, image_size, out):
+    """Renders the (zero-based) page index of pdf into the RGB array out.
 
-def _rasterize_worker(pdfpath, aspect, pagelimit, size_queue, image_queue):
+    Pages whose aspect ratio differs from the slab are centered and clipped,
+    leaving the rest of out untouched (black).
+    """
+    _, height = image_size
+    page = pdf[index]
+    scale = height / page.get_height()
+    # rev_byteorder asks PDFium for RGB instead of its native BGR, so the
+    # pixels can be copied straight into the slab.
+    bitmap = page.render(scale=scale, rev_byteorder=True)
+    pixels = bitmap.to_numpy()
+    _copy_centered(pixels, out)
+    page.close()
+
+
+# Each render process opens the PDF once, in _init_render_process.
+_process_pdf = None
+# Renders that cannot use the processes happen in the worker threads instead,
+# but PDFium is not thread-safe, so only one thread may call it at a time.
+# Those threads share one document per path, opened on first use.
+_local_lock = threading.Lock()
+_local_pdfs = {}
+
+
+def _init_render_process(pdfpath):
+    global _process_pdf
+    _process_pdf = pdfium.PdfDocument(pdfpath)
+
+
+def _render_locally(pdfpath, index, image_size, out):
+    """Renders the page into out in this process. Returns the seconds it took."""
+    with _local_lock:
+        start = time.perf_counter()
+        pdf = _local_pdfs.get(pdfpath)
+        if pdf is None:
+            pdf = _local_pdfs[pdfpath] = pdfium.PdfDocument(pdfpath)
+        _render_page(pdf, index, image_size, out)
+        return time.perf_counter() - start
+
+
+def _render_in_process(index, image_size, slab_name, slab_shape, slot):
+    """Renders the page into slab[slot]. Returns the seconds it took."""
+    start = time.perf_counter()
+    block = shared_memory.SharedMemory(name=slab_name)
+    try:
+        slab = np.ndarray(slab_shape, dtype=np.uint8, buffer=block.buf)
+        _render_page(_process_pdf, index, image_size, slab[slot])
+        # Views of the buffer must be gone before close().
+        del slab
+    finally:
+        block.close()
+    return time.perf_counter() - start
+
+
+def _noop():
+    pass
+
+
+def new_render_pool(pdfpath):
+    """Creates a process pool for rasterizing pages of the PDF in parallel.
+
+    All the processes are started right away, so call this before creating
+    any windows or threads.
+    """
+    # Spawn on every platform: it is the only start method on Windows and the
+    # default on macOS, and forking a process that has GUI threads or a
+    # display connection is unsafe. The price is that each process imports the
+    # main module, which must therefore be cheap and side-effect free.
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=MAX_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_render_process,
+        initargs=(pdfpath,),
+    )
+    # The pool only starts a process when a task finds none idle, so give it
+    # one task per process. This also gets the imports and PDF opening out of
+    # the way before the first real render.
+    for _ in range(MAX_PROCESSES):
+        pool.submit(_noop)
+    return pool
+
+
+def _copy_centered(src, dst):
+    """Copies src into the middle of dst, clipping if src is bigger."""
+    h = min(src.shape[0], dst.shape[0])
+    w = min(src.shape[1], dst.shape[1])
+    sy, sx = (src.shape[0] - h) // 2, (src.shape[1] - w) // 2
+    dy, dx = (dst.shape[0] - h) // 2, (dst.shape[1] - w) // 2
+    dst[dy:dy+h, dx:dx+w] = src[sy:sy+h, sx:sx+w]
+
+
+def _distance(page, cursors):
+    return min(abs(page - cursor) for cursor in cursors)
+
+
+def _prefetch_order(pages, cursors):
+    """Sorts (zero-based) page indices nearest-first around any of cursors."""
+    return sorted(pages, key=lambda p: _distance(p, cursors))
+
+
+class Render:
+    """The pages of one image size that are resident in memory.
+
+    A long deck at a high resolution does not fit in memory, so a render only
+    has a fixed number of slots - as many pages as fit in RENDER_BYTES, but at
+    least MIN_SLOTS. The worker thread keeps the pages nearest the cursors in
+    them, reusing the slot of the farthest page no longer wanted when it runs
+    out. Pages that were evicted are rendered again when a cursor comes back.
+
+    Only the worker thread modifies a Render. Other threads only read slab and
+    pages.
+
+    Attributes:
+        size: (width, height) the pages were rendered for.
+        npages: Number of pages in the deck.
+        slab: (slots, height, width, 3) array of RGB pixels (see _new_slab).
+        slab_name: Name of the slab's SharedMemory block, or None if the slab
+            is in plain memory and its pages must be rendered locally.
+        pages: pages[slot] is the (zero-based) index of the page whose pixels
+            are complete in slab[slot], or None. The worker sets it to None
+            before the slot is written and to the page after, so a reader that
+            finds the same page there before and after copying slab[slot] got
+            consistent pixels.
+        secs: Total time spent rendering or loading pages into the slab.
+        black: The slide to show for an out-of-bounds index instead of
+            crashing, in the slab's page shape.
+    """
+    def __init__(self, size, npages, shared=True):
+        self.size = size
+        self.npages = npages
+        shape = _slab_shape(size, npages)
+        self.slab, self.slab_name = _new_slab(shape, shared)
+        nslots = len(self.slab)
+        self.pages = [None] * nslots
+        # A read-only zero-stride view: no allocation or memset per render.
+        self.black = np.broadcast_to(np.uint8(0), shape[1:])
+        self.secs = 0.0
+        self.started = time.perf_counter()
+        self.finished = False
+        # Worker bookkeeping: the page each slot is assigned to, including
+        # pages still being written, and its inverse. Slots being written must
+        # not be reassigned.
+        self._assigned = [None] * nslots
+        self._slots = {}
+        self._busy = set()
+        self._cursors = (0,)
+        self._wanted = set()
+
+    def resident(self):
+        """Returns (slot, index) for each complete page."""
+        return [(s, p) for s, p in enumerate(self.pages) if p is not None]
+
+    # Methods for the worker thread.
+    def missing(self, cursors):
+        """Returns the pages that should be resident but are not, in order.
+
+        cursors are the (zero-based) indices of the pages the windows show.
+        """
+        wanted = _prefetch_order(range(self.npages), cursors)
+        wanted = wanted[:len(self.slab)]
+        self._cursors = cursors
+        self._wanted = set(wanted)
+        return [p for p in wanted if p not in self._slots]
+
+    def claim(self, index):
+        """Assigns a slot to the page, evicting a page that is not wanted.
+
+        Returns the slot, or None if every slot is wanted or being written.
+        """
+        def preference(slot):
+            page = self._assigned[slot]
+            if page is None:
+                # Free slots first, in order, so they fill front to back.
+                return (0, slot)
+            # Otherwise evict the farthest page from the cursors.
+            return (1, -_distance(page, self._cursors))
+        candidates = [
+            s for s, page in enumerate(self._assigned)
+            if s not in self._busy and page not in self._wanted
+        ]
+        if not candidates:
+            return None
+        slot = min(candidates, key=preference)
+        old = self._assigned[slot]
+        if old is not None:
+            del self._slots[old]
+        self.pages[slot] = None
+        self._assigned[slot] = index
+        self._slots[index] = slot
+        self._busy.add(slot)
+        return slot
+
+    def fill(self, slot, index, secs):
+        """Marks the page claimed for slot as complete."""
+        self._busy.discard(slot)
+        self.pages[slot] = index
+        self.secs += secs
+
+    def unclaim(self, slot, index):
+        """Frees a slot whose page will not be written after all."""
+        self._busy.discard(slot)
+        self._assigned[slot] = None
+        del self._slots[index]
+
+
+def _rasterize_worker(
+        pdfpath, pool, pagelimit, size_slot, cursor_slot, wakeup, image_queue):
     """Threaded interruptible PDF rasterizer.
 
-    Listens on size_queue for (width, height) tuples representing window resize
-    events. When an event arrives, discards any in-progress rasterization and
-    starts over. Calls the callback on its own thread when the images for the
-    entire PDF are complete and the size has not changed during rasterization.
+    Watches size_slot for (width, height) tuples representing window resize
+    events. When an event arrives, switches to the Render for that size (see
+    Render), creating it or taking it from memory, and puts (render, None,
+    None) on image_queue. Renders of other sizes that were slow to produce are
+    kept, within CACHE_BYTES in all.
+
+    Keeps the pages nearest the most recent tuple of (zero-based) page indices
+    set in cursor_slot - every page the windows show - resident in the current
+    render, nearest-first, so the pages the user is about to see are ready
+    before the rest of the deck. As each
+    page lands in a slot, puts (render, slot, index) on image_queue, so the
+    GUI can show pages before the whole deck is done. The rendering itself is
+    farmed out to the processes of pool, one page per task.
+
+    A page that fails to render is logged and shown black. If the pool breaks
+    (a render process died), logs it and renders in this thread from then on.
 
     Args:
         pdfpath (str): Path of PDF file.
-        aspect (float): Aspect ratio (width/height) of PDF file.
+        pool (Executor): Pool from new_render_pool(pdfpath).
         pagelimit (int): Read this many pages from the file. (Mostly for
             development purposes to keep load time down.)
-        size_queue (queue-like): Queue to monitor for size changes.
-        image_queue (queue-like): Queue to return completed renders.
+        size_slot (Latest): Slot to monitor for size changes.
+        cursor_slot (Latest): Slot to monitor for cursor changes.
+        wakeup (Event): Set by both slots.
+        image_queue (queue-like): Queue to return renders and their pages.
     """
-    images = [None] * pagelimit
+    cache = DiskCache(pdfpath)
+    cursors = (0,)
+
+    # The render we are filling, and those we keep for other sizes.
+    render = None
+    renders = LRUDict(CACHE_BYTES, cost=lambda render: render.slab.nbytes)
+
+    # Loop invariant: these are the (zero-based) indices of the pages we still
+    # need to rasterize, in the order we should rasterize them. If empty, we
+    # have no work to do.
+    todo = []
+
+    # Pages being rendered by the pool, as future -> (render, slot, index).
+    inflight = {}
 
-    # Loop invariant: this is the (one-based) index of the page we should
-    # rasterize next. If it exceeds page_limit, we have no work to do.
-    page = 1
+    # Pages rendered but not yet written to the disk cache, as (render, slot,
+    # index). Compressing a page costs a good fraction of rendering it, so we
+    # defer writes until there is nothing left to render.
+    unsaved = []
 
-    # Block indefinitely for first size.
-    image_size = size_queue.get()
+    # Whether the pool still works. If a render process dies, the pool is
+    # broken for good, and we render everything here from then on.
+    shared = True
+    broken = False
 
     while True:
-        # Get freshest item in size_queue. This loop would not be necessary if
-        # it was possible for a Queue with a maxsize to discard old items
-        # instead of blocking when it's full and put() is called.
-        try:
-            while True:
-                image_size = size_queue.get(timeout=0.1)
-                if image_size == _EXIT_SENTINEL:
-                    # Stop the thread and exit cleanly.
-                    return
-                elif image_size == _IDLE_SENTINEL:
-                    # If working, stop.
-                    page = pagelimit + 1
-                    images = [None] * pagelimit
+        if broken and shared:
+            print("render processes died, rendering in this process.")
+            shared = False
+            # Every page still in flight is lost.
+            for r, slot, index in inflight.values():
+                r.unclaim(slot, index)
+            inflight = {}
+            # Running out of shared memory is the usual reason processes die,
+            # and writing to these slabs here could kill us the same way, so
+            # start over in plain memory.
+            renders.clear()
+            unsaved = []
+            if render is not None:
+                render = Render(render.size, pagelimit, shared)
+                image_queue.put((render, None, None))
+                todo = render.missing(cursors)
+
+        # Checking the slots is cheap, so we do it between every page. We only
+        # block when there is nothing else to do (including at startup). Even
+        # then a cursor move can bring back evicted pages, so wake up for
+        # either slot.
+        idle = (
+            not todo and not inflight and not unsaved
+            and (render is None or render.finished)
+        )
+        if idle:
+            # Leftovers of the last pass must not keep a dead slab alive while
+            # we sleep.
+            old = r = None
+            wakeup.wait()
+            # Clear before taking, so a set() in between is not lost.
+            wakeup.clear()
+        new_size = size_slot.take()
+        if render is not None and new_size == render.size:
+            # Already rendering this size - don't start over.
+            new_size = None
+        if new_size is not None:
+            # Abandon pages still waiting for a process. Pages already being
+            # rendered are left to finish, since they can still be cached.
+            for future, (r, slot, index) in list(inflight.items()):
+                if future.cancel():
+                    r.unclaim(slot, index)
+                    del inflight[future]
+        if new_size == _EXIT_SENTINEL:
+            # Stop the thread and exit cleanly.
+            return
+        elif new_size == _IDLE_SENTINEL:
+            # If working, stop.
+            _keep(renders, render)
+            render = None
+            todo = []
+        elif new_size is not None:
+            old = render
+            render = renders.pop(new_size)
+            if render is not None:
+                w, h = new_size
+                print(f"retrieved ({w:.1f}, {h:.1f}) render from cache.")
+                nbytes = render.slab.nbytes
+            else:
+                nbytes = math.prod(_slab_shape(new_size, pagelimit))
+            # Make room before allocating, not after.
+            renders.set_budget(CACHE_BYTES - nbytes)
+            _keep(renders, old)
+            # Pages of renders we dropped are not worth the disk space, and
+            # holding on to them would keep their slabs alive.
+            alive = [render, *renders.values()]
+            unsaved = [u for u in unsaved if any(u[0] is r for r in alive)]
+            if render is None:
+                render = Render(new_size, pagelimit, shared)
+            image_queue.put((render, None, None))
+            todo = render.missing(cursors)
+
+        # The cursor never interrupts work - it just reprioritizes what is
+        # left, or brings evicted pages back.
+        new_cursors = cursor_slot.take()
+        if new_cursors is not None and new_cursors != cursors:
+            cursors = new_cursors
+            if render is not None:
+                todo = render.missing(cursors)
+
+        # Keep every process busy, but no more, so reprioritizing still works.
+        loaded = False
+        while todo and len(inflight) < MAX_PROCESSES:
+            slot = render.claim(todo[0])
+            if slot is None:
+                # Wait for a slot to finish being written.
+                break
+            index = todo.pop(0)
+            start = time.perf_counter()
+            pixels = cache.load(render.size, index)
+            if pixels is not None and pixels.shape == render.slab[slot].shape:
+                render.slab[slot] = pixels
+                render.fill(slot, index, time.perf_counter() - start)
+                image_queue.put((render, slot, index))
+                # Decompressing a page is not free either, so check the slots
+                # again before the next one.
+                loaded = True
+                break
+            if render.slab_name is None:
+                # The processes cannot reach this slab. Render here, and check
+                # the slots again before the next page, as for a cache hit.
+                try:
+                    secs = _render_locally(
+                        pdfpath, index, render.size, render.slab[slot])
+                except Exception as e:
+                    _blank_failed(render, slot, index, e)
                 else:
-                    page = 1
-        except queue.Empty:
-            pass
-
-        if page == pagelimit + 1:
-            # Got through them all without changing size - push exactly once.
-            if images[-1] is not None:
-                image_queue.put((image_size, images))
-                images = [None] * pagelimit
-        else:
-            # One might hope that pdf2image.convert_from_bytes is faster by
-            # staying in-memory, but it just writes the bytes to a temp file.
-            chunk = pdf2image.convert_from_path(
-                pdfpath,
-                thread_count=MAX_THREADS,
-                size=image_size,
-                first_page=page,
-                last_page=page+CHUNK_PAGES-1,
+                    render.fill(slot, index, secs)
+                    unsaved.append((render, slot, index))
+                image_queue.put((render, slot, index))
+                loaded = True
+                break
+            try:
+                future = pool.submit(
+                    _render_in_process,
+                    index,
+                    render.size,
+                    render.slab_name,
+                    render.slab.shape,
+                    slot,
+                )
+            except concurrent.futures.process.BrokenProcessPool:
+                render.unclaim(slot, index)
+                todo.insert(0, index)
+                broken = True
+                break
+            inflight[future] = (render, slot, index)
+
+        if inflight:
+            # After a cache hit, only collect what is already done - the next
+            # page may well be another hit.
+            done, _ = concurrent.futures.wait(
+                inflight,
+                timeout=0 if loaded else None,
+                return_when=concurrent.futures.FIRST_COMPLETED,
             )
-            for img in chunk:
-                images[page - 1] = img
-                page += 1
+            for future in done:
+                r, slot, index = inflight.pop(future)
+                # The pixels are already in the slab; the result is only how
+                # long they took, or the error from the render process.
+                try:
+                    secs = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    r.unclaim(slot, index)
+                    broken = True
+                    continue
+                except Exception as e:
+                    _blank_failed(r, slot, index, e)
+                else:
+                    r.fill(slot, index, secs)
+                    unsaved.append((r, slot, index))
+                if r is render:
+                    image_queue.put((r, slot, index))
+        elif todo:
+            # Only reachable after a cache hit. Go back for the next page.
+            continue
+        elif render is not None and not render.finished:
+            render.finished = True
+            w, h = render.size
+            duration = time.perf_counter() - render.started
+            print(f"rendered ({w:.1f}, {h:.1f}) in {duration:.2f} sec.")
+        elif unsaved:
+            # Renders of an abandoned size are still worth caching, but a slot
+            # may have been reused since.
+            r, slot, index = unsaved.pop()
+            if r.pages[slot] == index:
+                cache.store(r.size, index, r.slab[slot])
+
+
+def _blank_failed(render, slot, index, error):
+    """Shows a page that failed to render as black, instead of retrying it."""
+    print(f"failed to render page {index + 1}: {error!r}")
+    render.slab[slot] = 0
+    render.fill(slot, index, 0.0)
+
+
+def _keep(renders, render):
+    """Keeps the render we are leaving if it was slow to produce."""
+    if render is not None and render.secs >= MIN_CACHE_SECS:
+        renders[render.size] = render
 
 
 class ThreadedRasterizer:
     """Shared state for communicating with _rasterize_worker thread.
 
-    Also implements the behavior of showing a black slide for an out-of-bounds
+    Each Render also carries the black slide to show for an out-of-bounds
     index instead of crashing. In a larger program this should probably be a
     separate layer between the rasterizer and the platform-specific GUI. For
     now it goes here to keep the Pyglet-specific layer as thin as possible.
     """
-    def __init__(self, path, pagelimit=None):
-        self.images = None
-        self.black = None
-        self.render_start_time = None
-
-        self.cache = LRUDict(4)
-
-        info = pdf2image.pdfinfo_from_path(path)
-        self.aspect = _parse_aspect_from_pdfinfo(info)
-
-        self.size_queue = queue.Queue()
-        self.image_queue = queue.Queue()
+    def __init__(self, path, pool, pagelimit=None):
+        # The Render we are showing, and (slot, index) for each page that
+        # landed in it, in the order they arrived. Pages stream in while a
+        # render is running, and again whenever the cursor brings back pages
+        # that were evicted.
+        self.render = None
+        self.ready = []
+        # Pyglet sends on_resize for more than real size changes, e.g. when a
+        # window is shown. Remember the last size so we can ignore repeats.
+        self.last_size = None
+
+        # The worker is a thread, not a process, so no pickling or pipes are
+        # needed. Only the latest size and cursor matter, but every page that
+        # lands is worth knowing about. SimpleQueue is implemented in C and
+        # skips the task tracking of queue.Queue, which we never use.
+        self.wakeup = threading.Event()
+        self.size_slot = Latest(self.wakeup)
+        self.cursor_slot = Latest(self.wakeup)
+        self.image_queue = queue.SimpleQueue()
         self.thread = threading.Thread(
             target=_rasterize_worker,
-            args=(path, self.aspect, pagelimit, self.size_queue, self.image_queue),
+            args=(
+                path,
+                pool,
+                pagelimit,
+                self.size_slot,
+                self.cursor_slot,
+                self.wakeup,
+                self.image_queue,
+            ),
         )
         self.thread.start()
 
     def push_resize(self, w, h):
-        if (w, h) not in self.cache:
-            self.size_queue.put((w, h))
-            self.render_start_time = time.time()
-        else:
-            # _IDLE_SENTINEL avoids the following bug:
-            # 1) resize to non-cached size 1, start a render
-            # 2) resize to cached size 2 before render is done
-            # 3) render of now-invalid size 1 finishes, is pushed to image_queue
-            self.size_queue.put(_IDLE_SENTINEL)
-            self._set_images(self.cache[(w, h)])
-            print(f"retrieved ({w:.1f}, {h:.1f}) render from cache.")
-
-    def get(self, index):
-        try:
-            (w, h), images = self.image_queue.get(block=False)
-            self.cache[(w, h)] = images
-            self._set_images(images)
-            duration = time.time() - self.render_start_time
-            print(f"rendered ({w:.1f}, {h:.1f}) in {duration:.2f} sec.")
-        except queue.Empty:
-            pass
-        if self.images is None:
-            return None
-        if 0 <= index < len(self.images):
-            return self.images[index]
-        return self.black
+        if (w, h) == self.last_size:
+            return
+        self.last_size = (w, h)
+        self.size_slot.set((w, h))
+
+    def push_cursor(self, pages):
+        """Tells the worker which pages are shown, to rasterize around first.
+
+        pages is a tuple of (zero-based) page indices. It replaces the last
+        one, so it must cover every window this rasterizer serves.
+        """
+        self.cursor_slot.set(pages)
+
+    def idle(self):
+        """Abandons any in-progress rasterization."""
+        self.last_size = None
+        self.size_slot.set(_IDLE_SENTINEL)
+
+    def get_all(self):
+        """Returns (render, ready) for the Render we are showing.
+
+        render is None before the worker starts the first one. ready lists
+        (slot, index) for each page that landed in render.slab, in arrival
+        order. A later entry for the same slot replaces an earlier one, and
+        the slot may already hold another page (see Render.pages). ready only
+        grows until it is replaced by another list, so callers can track how
+        much of it they have already seen as long as it is the same list.
+        """
+        # Slabs die on this thread too, when the last window lets go of them.
+        _close_dead_blocks()
+        while True:
+            try:
+                render, slot, index = self.image_queue.get(block=False)
+            except queue.Empty:
+                break
+            if slot is None:
+                # The worker switched renders. Pages may already be resident
+                # if it had kept this one from before.
+                self._set_render(render)
+            elif render is self.render:
+                self.ready.append((slot, index))
+            # Otherwise the page belongs to a render the worker left since.
+        return self.render, self.ready
 
     def shutdown(self):
-        self.size_queue.put(_EXIT_SENTINEL)
+        self.size_slot.set(_EXIT_SENTINEL)
         self.thread.join()
 
-    def _set_images(self, images):
-        self.images = images
-        lut = [0] * (256 * 3)
-        self.black = images[0].point(lut)
+    # Private methods.
+    def _set_render(self, render):
+        self.render = render
+        self.ready = render.resident()
+
+
+class SharedRasterizer:
+    """Dedupes rasterization between several windows showing the same PDF.
+
+    Windows are identified by any hashable id. Windows that want the same
+    image size share one ThreadedRasterizer, so e.g. two fullscreen windows on
+    identical monitors rasterize the deck once. Windows that want different
+    sizes each get their own, created lazily and reused across resizes. There
+    are never more ThreadedRasterizers than windows. They all share one pool
+    of render processes.
+
+    Each ThreadedRasterizer is told about the pages shown by all the windows
+    it serves, and told again whenever those windows change, so a rasterizer
+    a window just moved to does not keep rendering around someone else's (or
+    nobody's) slides.
+
+    aspect (width/height of the PDF's pages) is only stored for the windows'
+    layout code; this class does not read the PDF's metadata itself.
+    """
+    def __init__(self, path, aspect, pagelimit=None):
+        self.path = path
+        self.aspect = aspect
+        self.pagelimit = pagelimit
+        self.pool = new_render_pool(path)
+        self.rasterizers = [ThreadedRasterizer(path, self.pool, pagelimit)]
+        self.assigned = {}
+        self.sizes = {}
+        self.cursors = {}
+
+    def push_resize(self, window_id, w, h):
+        current = self.assigned.get(window_id)
+        if current is not None and self.sizes[window_id] == (w, h):
+            return
+        self.sizes[window_id] = (w, h)
+        for other_id, other in self.assigned.items():
+            if other_id != window_id and self.sizes[other_id] == (w, h):
+                self.assigned[window_id] = other
+                if current is not None and current is not other:
+                    self._release(current)
+                self._push_cursors(other)
+                return
+        if current is None or self._is_shared(current, window_id):
+            old = current
+            current = self._get_free()
+            self.assigned[window_id] = current
+            if old is not None:
+                self._release(old)
+        # Before the size, so the worker starts the render at our slides.
+        self._push_cursors(current)
+        current.push_resize(w, h)
+
+    def push_cursor(self, window_id, pages):
+        """Remembers the (zero-based) indices of the pages the window shows."""
+        self.cursors[window_id] = tuple(pages)
+        rasterizer = self.assigned.get(window_id)
+        if rasterizer is not None:
+            self._push_cursors(rasterizer)
+
+    def get_all(self, window_id):
+        rasterizer = self.assigned.get(window_id)
+        if rasterizer is None:
+            return None, []
+        return rasterizer.get_all()
+
+    def remove(self, window_id):
+        """Forgets the window. Shuts down everything after the last one."""
+        rasterizer = self.assigned.pop(window_id, None)
+        self.sizes.pop(window_id, None)
+        self.cursors.pop(window_id, None)
+        if rasterizer is not None:
+            self._release(rasterizer)
+        if not self.assigned:
+            for rasterizer in self.rasterizers:
+                rasterizer.shutdown()
+            self.rasterizers = []
+            self.pool.shutdown(cancel_futures=True)
+
+    # Private methods.
+    def _is_shared(self, rasterizer, window_id):
+        return any(
+            other is rasterizer
+            for other_id, other in self.assigned.items()
+            if other_id != window_id
+        )
+
+    def _release(self, rasterizer):
+        if rasterizer not in self.assigned.values():
+            rasterizer.idle()
+        else:
+            # The windows left on it no longer need the pages we showed.
+            self._push_cursors(rasterizer)
+
+    def _push_cursors(self, rasterizer):
+        pages = set()
+        for window_id, other in self.assigned.items():
+            if other is rasterizer:
+                pages.update(self.cursors.get(window_id, ()))
+        if pages:
+            rasterizer.push_cursor(tuple(sorted(pages)))
+
+    def _get_free(self):
+        in_use = list(self.assigned.values())
+        for rasterizer in self.rasterizers:
+            if rasterizer not in in_use:
+                return rasterizer
+        rasterizer = ThreadedRasterizer(self.path, self.pool, self.pagelimit)
+        self.rasterizers.append(rasterizer)
+        return rasterizer